@@ -3,8 +3,14 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
+import re
 from datetime import datetime, timedelta
 
+try:
+    import graphviz
+except ImportError: # Optional: the system diagram is skipped if graphviz is not installed
+    graphviz = None
+
 # --- PAGE CONFIG ---
 st.set_page_config(
     page_title="Energy SCADA & Financial Dashboard",
@@ -35,6 +41,21 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# --- CONSTANTS ---
+PROCESSES = ['Chillers', 'Compressor 1', 'Compressor 2', 'Trafo 1', 'Trafo 2', 
+             'Extraction', 'Supply Air 1', 'Supply Air 2', 'Filing', 'Polishing', 'LPDC']
+REGIONS = ['Mainland', 'Balearic', 'Canary', 'Ceuta', 'Melilla']
+# Column names per region, resolved once instead of formatted on every lookup
+REGION_COLS = {
+    r: {'amount': f'{r}_Amount', 'pass_through': [f'{r}_PassThrough_PMD', f'{r}_PassThrough_Ai']}
+    for r in REGIONS
+}
+AMOUNT_COLS = [REGION_COLS[r]['amount'] for r in REGIONS]
+
+# Advisor intents, listed in the order they take precedence when a query matches several
+INTENT_RE = re.compile(r'(?P<cost>expensive|cost)|(?P<proc>process|consume)|(?P<opt>optimize)', re.IGNORECASE)
+INTENT_PRIORITY = ['cost', 'proc', 'opt']
+
 # --- MOCK DATA GENERATOR ---
 # (In production, this replaces the Excel upload if no file is provided)
 @st.cache_data
@@ -43,40 +64,165 @@ def generate_mock_data():
     dates = pd.date_range(end=datetime.now(), periods=24*30, freq='H')
     
     # Processes
-    processes = ['Chillers', 'Compressor 1', 'Compressor 2', 'Trafo 1', 'Trafo 2', 
-                 'Extraction', 'Supply Air 1', 'Supply Air 2', 'Filing', 'Polishing', 'LPDC']
+    processes = PROCESSES
+    rng = np.random.default_rng(0)
     
-    data = {'Timestamp': dates}
+    # Generate consumption data with some randomness (one draw for all processes)
+    bases = rng.uniform(50, 200, len(processes))
+    mat = rng.normal(bases, bases*0.1, size=(len(dates), len(processes))).astype(np.float32)
     
-    # Generate consumption data with some randomness
-    for p in processes:
-        base = np.random.uniform(50, 200)
-        data[p] = np.random.normal(base, base*0.1, len(dates))
+    df_hist = pd.DataFrame(mat, columns=processes, index=dates.rename('Timestamp'))
     
     # L1 Site (Total)
-    df_hist = pd.DataFrame(data)
-    df_hist['L1 Site'] = df_hist[processes].sum(axis=1)
+    l1_site = mat.sum(axis=1)
+    df_hist['L1 Site'] = l1_site
     
     # Financial Data (Regions)
-    regions = ['Mainland', 'Balearic', 'Canary', 'Ceuta', 'Melilla']
-    for r in regions:
-        df_hist[f'{r}_Amount'] = df_hist['L1 Site'] * np.random.uniform(0.15, 0.25) # Cost
+    regions = REGIONS
+    factors = rng.uniform(0.15, 0.25, len(regions)).astype(np.float32) # Cost
+    amounts = l1_site[:, None] * factors
+    
+    # Collect region columns and attach them in one concat instead of per-column inserts
+    region_cols = {}
+    for i, r in enumerate(regions):
+        pmd_col, ai_col = REGION_COLS[r]['pass_through']
+        region_cols[REGION_COLS[r]['amount']] = amounts[:, i]
         # Pass through mock
-        df_hist[f'{r}_PassThrough_PMD'] = df_hist[f'{r}_Amount'] * 0.1
-        df_hist[f'{r}_PassThrough_Ai'] = df_hist[f'{r}_Amount'] * 0.05
+        region_cols[pmd_col] = amounts[:, i] * 0.1
+        region_cols[ai_col] = amounts[:, i] * 0.05
+    df_hist = pd.concat([df_hist, pd.DataFrame(region_cols, index=df_hist.index)], axis=1)
+    
+    # float32 halves memory and the payload Plotly ships to the browser
+    df_hist = df_hist.astype('float32')
     
     # Forecast Data (Next 7 days)
     future_dates = pd.date_range(start=dates[-1], periods=24*7, freq='H')
     forecast_data = {'Timestamp': future_dates}
-    forecast_data['Predicted_Energy'] = np.random.normal(1500, 200, len(future_dates))
+    forecast_data['Predicted_Energy'] = rng.normal(1500, 200, len(future_dates))
     
     for r in regions:
-        forecast_data[f'{r}_cost_safe'] = forecast_data['Predicted_Energy'] * np.random.uniform(0.18, 0.28)
+        forecast_data[f'{r}_cost_safe'] = forecast_data['Predicted_Energy'] * rng.uniform(0.18, 0.28)
         
     df_forecast = pd.DataFrame(forecast_data)
+    df_forecast = df_forecast.astype({c: 'float32' for c in df_forecast.columns if c != 'Timestamp'})
     
     return df_hist, df_forecast
 
+@st.cache_data
+def summarize(_df_hist, last_ts, cols):
+    # Averages only over the columns the SCADA cards read, plus the latest reading;
+    # keyed on the last timestamp rather than hashing the frame
+    return _df_hist[cols].mean(), _df_hist.iloc[-1]
+
+@st.cache_data
+def precompute_stats(_df_hist, last_ts, region):
+    # Reductions shared by the KPI row and the advisor, recomputed only when the data or region changes
+    proc_sums = _df_hist[PROCESSES].sum().sort_values(ascending=False)
+    return {
+        'proc_sums': proc_sums,
+        'max_cost_idx': _df_hist[REGION_COLS[region]['amount']].idxmax(),
+        'top_consumer': proc_sums.index[0],
+    }
+
+def hm_matrix(load):
+    # Day x Hour matrix of the mean site load, rows in calendar order;
+    # cached through build_heatmap_figure, so no cache layer of its own
+    mat = load.groupby([load.index.day_name(), load.index.hour]).mean().unstack(fill_value=0)
+    days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    return mat.reindex([day for day in days if day in mat.index])
+
+@st.cache_resource
+def build_graph_skeleton():
+    # Static part of the system diagram; only the transformer labels change per reading
+    graph = graphviz.Digraph()
+    graph.attr(rankdir='LR', bgcolor='transparent')
+    graph.attr('node', shape='box', style='filled', fillcolor='#262730', fontcolor='white', color='white')
+    graph.edge_attr.update(color='white')
+    
+    graph.node('Grid', 'External Grid', shape='ellipse', fillcolor='#4CAF50')
+    graph.node('T1', 'Trafo 1')
+    graph.node('T2', 'Trafo 2')
+    graph.node('Bus', 'Main Bus L1')
+    graph.node('Chiller', 'Chillers')
+    graph.node('Comp', 'Compressors')
+    graph.node('Prod', 'Production Line')
+    
+    graph.edges([('Grid', 'T1'), ('Grid', 'T2'), ('T1', 'Bus'), ('T2', 'Bus')])
+    graph.edges([('Bus', 'Chiller'), ('Bus', 'Comp'), ('Bus', 'Prod')])
+    return graph
+
+# --- CACHED FIGURES ---
+# Data frames are passed with a leading underscore so Streamlit doesn't hash them;
+# the cache key is the last history timestamp (plus region or forecast start where they matter).
+
+@st.cache_resource
+def build_trend_figure(_df_hist, last_ts):
+    df_trend = _df_hist.tail(168)[['L1 Site']]
+    fig = px.line(df_trend, x=df_trend.index, y='L1 Site', title="Last 7 Days Load Profile")
+    fig.update_traces(line_color='#00CC96')
+    return fig
+
+@st.cache_resource
+def build_heatmap_figure(_df_hist, last_ts):
+    mat = hm_matrix(_df_hist['L1 Site'].tail(24*7))
+    fig = go.Figure(go.Heatmap(z=mat.values, x=mat.columns, y=mat.index, colorscale='Viridis'))
+    fig.update_layout(xaxis_title='Hour', yaxis_title='Day')
+    return fig
+
+@st.cache_resource
+def build_pass_through_figure(_df_hist, last_ts, region):
+    pt_cols = REGION_COLS[region]['pass_through']
+    df_pt = _df_hist.tail(168)[pt_cols] # Last 7 days
+    return px.area(df_pt, x=df_pt.index, y=pt_cols, title="Pass-Through Cost Components (7 Days)")
+
+@st.cache_resource
+def build_region_totals_figure(totals):
+    # totals: tuple of (region, total cost) pairs
+    df_compare = pd.DataFrame(list(totals), columns=['Region', 'Total Cost'])
+    return px.bar(df_compare, x='Region', y='Total Cost', color='Region', title="Total Cost by Region (All History)")
+
+@st.cache_resource
+def build_forecast_figure(_df_hist, _df_forecast, last_ts, forecast_start):
+    # Merge History and Forecast for visualization
+    fig = go.Figure()
+    
+    # Historical Line
+    hist_slice = _df_hist.tail(48) # Last 48h
+    fig.add_trace(go.Scatter(x=hist_slice.index.to_numpy(), y=hist_slice['L1 Site'].to_numpy(), name='Historical', line=dict(color='gray')))
+    
+    # Forecast Line
+    fore_slice = _df_forecast.head(48) # Next 48h
+    fig.add_trace(go.Scatter(x=fore_slice['Timestamp'].to_numpy(), y=fore_slice['Predicted_Energy'].to_numpy(), name='Predicted', line=dict(color='#00CC96', dash='dot')))
+    
+    fig.update_layout(title="Energy Consumption Forecast (Next 48h)", xaxis_title="Time", yaxis_title="kWh")
+    return fig
+
+@st.cache_resource
+def build_cost_table_figure(_df_forecast, first_ts):
+    # Keyed on the forecast's own start so a new forecast is not masked by unchanged history
+    cols_cost = [c for c in _df_forecast.columns if 'cost_safe' in c]
+    df_cost = _df_forecast.head(24)[['Timestamp'] + cols_cost]
+    
+    # Per-column min-max scaling (like Styler.background_gradient) mapped onto the Reds scale;
+    # a flat column has zero range and maps to the bottom of the scale
+    vals = df_cost[cols_cost]
+    value_range = (vals.max() - vals.min()).replace(0, 1)
+    norms = ((vals - vals.min()) / value_range).to_numpy()
+    colors = np.array(px.colors.sample_colorscale('Reds', norms.ravel())).reshape(norms.shape)
+    fill_color = [['white'] * len(df_cost)] + colors.T.tolist()
+    font_color = [['black'] * len(df_cost)] + np.where(norms > 0.6, 'white', 'black').T.tolist()
+    
+    fig = go.Figure(go.Table(
+        header=dict(values=['Timestamp'] + cols_cost),
+        cells=dict(
+            values=[df_cost['Timestamp'].dt.strftime('%Y-%m-%d %H:%M')] + [vals[c].astype('float64').round(2) for c in cols_cost],
+            fill_color=fill_color,
+            font=dict(color=font_color),
+        ),
+    ))
+    fig.update_layout(height=600, margin=dict(l=0, r=0, t=0, b=0))
+    return fig
+
 # --- MAIN APP LOGIC ---
 
 def main():
@@ -95,8 +241,11 @@ def main():
         df_hist, df_forecast = generate_mock_data()
         
     # Global Region Selector
-    region = st.sidebar.selectbox("Select Region Focus", 
-                                  ["Mainland", "Balearic", "Canary", "Ceuta", "Melilla"])
+    region = st.sidebar.selectbox("Select Region Focus", REGIONS)
+
+    last_ts = df_hist.index[-1]
+    avg_vals, latest = summarize(df_hist, last_ts, PROCESSES + ['L1 Site'])
+    stats = precompute_stats(df_hist, last_ts, region)
 
     # Navigation
     tab_main, tab_scada, tab_fin, tab_fore, tab_ai = st.tabs([
@@ -112,30 +261,24 @@ def main():
         st.subheader("Operational Overview (L1 Site)")
         
         # Top KPIs
-        latest = df_hist.iloc[-1]
         prev = df_hist.iloc[-2]
         
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("Current Load (kW)", f"{latest['L1 Site']:.2f}", f"{latest['L1 Site'] - prev['L1 Site']:.2f} kW")
         col2.metric("Daily Peak (kW)", f"{df_hist.tail(24)['L1 Site'].max():.2f}")
-        col3.metric("Top Consumer", "Chillers") # Logic to find max col could go here
-        col4.metric(f"{region} Cost (Last Hr)", f"€{latest[f'{region}_Amount']:.2f}")
+        col3.metric("Top Consumer", stats['top_consumer'])
+        col4.metric(f"{region} Cost (Last Hr)", f"€{latest[REGION_COLS[region]['amount']]:.2f}")
         
         # Charts
         c1, c2 = st.columns([2, 1])
         with c1:
             st.markdown("#### Total Consumption Trend")
-            fig_trend = px.line(df_hist.tail(168), x='Timestamp', y='L1 Site', title="Last 7 Days Load Profile")
-            fig_trend.update_traces(line_color='#00CC96')
+            fig_trend = build_trend_figure(df_hist, last_ts)
             st.plotly_chart(fig_trend, use_container_width=True)
             
         with c2:
             st.markdown("#### Operating Hours Heatmap")
-            # Pivot for heatmap
-            df_hm = df_hist.tail(24*7).copy()
-            df_hm['Hour'] = df_hm['Timestamp'].dt.hour
-            df_hm['Day'] = df_hm['Timestamp'].dt.day_name()
-            fig_hm = px.density_heatmap(df_hm, x='Hour', y='Day', z='L1 Site', color_continuous_scale='Viridis')
+            fig_hm = build_heatmap_figure(df_hist, last_ts)
             st.plotly_chart(fig_hm, use_container_width=True)
 
     # --- TAB 2: SCADA VISUALIZATION ---
@@ -143,72 +286,57 @@ def main():
         st.subheader("Real-Time Facility Digital Twin")
         st.caption("Red Glow = Consumption > Average")
         
-        # Helper to render "SCADA Cards"
-        def render_machine(name, value, avg_val):
+        # Helper to build "SCADA Cards" HTML (kept unindented so joined cards stay one HTML block)
+        def card_html(name, value, avg_val):
             is_alert = value > (avg_val * 1.1) # Alert if 10% over average
             alert_class = "scada-alert" if is_alert else ""
             color = "#FF4B4B" if is_alert else "#00FF00"
             
-            html = f"""
-            <div class="scada-box {alert_class}">
-                <div class="scada-title">{name}</div>
-                <div class="scada-value" style="color: {color}">{value:.1f} kW</div>
-                <div style="font-size:10px; color:#666">Avg: {avg_val:.1f} kW</div>
-            </div>
-            """
+            return (
+                f'<div class="scada-box {alert_class}">'
+                f'<div class="scada-title">{name}</div>'
+                f'<div class="scada-value" style="color: {color}">{value:.1f} kW</div>'
+                f'<div style="font-size:10px; color:#666">Avg: {avg_val:.1f} kW</div>'
+                '</div>'
+            )
+
+        # Helper to render a column of cards with a single markdown call
+        def render_machines(machines):
+            html = "\n".join(card_html(name, latest[col], avg_vals[col]) for name, col in machines)
             st.markdown(html, unsafe_allow_html=True)
 
         # Layout - Manually placing items to mimic a floor plan
         c1, c2, c3, c4 = st.columns(4)
         
-        avg_vals = df_hist.mean()
-        
         with c1:
             st.markdown("### Power Input")
-            render_machine("Trafo 1", latest['Trafo 1'], avg_vals['Trafo 1'])
-            render_machine("Trafo 2", latest['Trafo 2'], avg_vals['Trafo 2'])
-            render_machine("Main Bus", latest['L1 Site'], avg_vals['L1 Site'])
+            render_machines([("Trafo 1", 'Trafo 1'), ("Trafo 2", 'Trafo 2'), ("Main Bus", 'L1 Site')])
             
         with c2:
             st.markdown("### Utility")
-            render_machine("Chillers", latest['Chillers'], avg_vals['Chillers'])
-            render_machine("Compressor 1", latest['Compressor 1'], avg_vals['Compressor 1'])
-            render_machine("Compressor 2", latest['Compressor 2'], avg_vals['Compressor 2'])
+            render_machines([("Chillers", 'Chillers'), ("Compressor 1", 'Compressor 1'), ("Compressor 2", 'Compressor 2')])
 
         with c3:
             st.markdown("### HVAC")
-            render_machine("Supply Air 1", latest['Supply Air 1'], avg_vals['Supply Air 1'])
-            render_machine("Supply Air 2", latest['Supply Air 2'], avg_vals['Supply Air 2'])
-            render_machine("Extraction", latest['Extraction'], avg_vals['Extraction'])
+            render_machines([("Supply Air 1", 'Supply Air 1'), ("Supply Air 2", 'Supply Air 2'), ("Extraction", 'Extraction')])
 
         with c4:
             st.markdown("### Production")
-            render_machine("LPDC", latest['LPDC'], avg_vals['LPDC'])
-            render_machine("Filing", latest['Filing'], avg_vals['Filing'])
-            render_machine("Polishing", latest['Polishing'], avg_vals['Polishing'])
+            render_machines([("LPDC", 'LPDC'), ("Filing", 'Filing'), ("Polishing", 'Polishing')])
             
         # Graphviz Flow Diagram
         st.markdown("---")
         st.subheader("System Logic Diagram")
         
         # Using Graphviz to draw the connections
-        graph = graphviz.Digraph()
-        graph.attr(rankdir='LR', bgcolor='transparent')
-        graph.attr('node', shape='box', style='filled', fillcolor='#262730', fontcolor='white', color='white')
-        graph.edge_attr.update(color='white')
-        
-        graph.node('Grid', 'External Grid', shape='ellipse', fillcolor='#4CAF50')
-        graph.node('T1', f'Trafo 1\n{latest["Trafo 1"]:.0f}kW')
-        graph.node('T2', f'Trafo 2\n{latest["Trafo 2"]:.0f}kW')
-        graph.node('Bus', 'Main Bus L1')
-        graph.node('Chiller', 'Chillers')
-        graph.node('Comp', 'Compressors')
-        graph.node('Prod', 'Production Line')
-        
-        graph.edges([('Grid', 'T1'), ('Grid', 'T2'), ('T1', 'Bus'), ('T2', 'Bus')])
-        graph.edges([('Bus', 'Chiller'), ('Bus', 'Comp'), ('Bus', 'Prod')])
-        
-        st.graphviz_chart(graph)
+        if graphviz is not None:
+            # Copy the cached skeleton: node() appends, so patching it in place would grow it every rerun
+            graph = build_graph_skeleton().copy()
+            graph.node('T1', f'Trafo 1\n{latest["Trafo 1"]:.0f}kW')
+            graph.node('T2', f'Trafo 2\n{latest["Trafo 2"]:.0f}kW')
+            st.graphviz_chart(graph)
+        else:
+            st.info("Install `graphviz` to display the system diagram.")
 
     # --- TAB 3: FINANCIAL DASHBOARD ---
     with tab_fin:
@@ -218,42 +346,26 @@ def main():
         
         with fc1:
             # Stacked Area for Pass Throughs
-            pt_cols = [c for c in df_hist.columns if f'{region}_PassThrough' in c]
-            df_pt = df_hist[['Timestamp'] + pt_cols].tail(168) # Last 7 days
-            
-            fig_fin = px.area(df_pt, x='Timestamp', y=pt_cols, title="Pass-Through Cost Components (7 Days)")
+            fig_fin = build_pass_through_figure(df_hist, last_ts, region)
             st.plotly_chart(fig_fin, use_container_width=True)
             
         with fc2:
             # Region Comparison
-            total_costs = {r: df_hist[f'{r}_Amount'].sum() for r in ["Mainland", "Balearic", "Canary", "Ceuta", "Melilla"]}
-            df_compare = pd.DataFrame(list(total_costs.items()), columns=['Region', 'Total Cost'])
-            
-            fig_bar = px.bar(df_compare, x='Region', y='Total Cost', color='Region', title="Total Cost by Region (All History)")
+            totals = df_hist[AMOUNT_COLS].sum()
+            fig_bar = build_region_totals_figure(tuple(zip(REGIONS, totals.tolist())))
             st.plotly_chart(fig_bar, use_container_width=True)
 
     # --- TAB 4: FORECAST DASHBOARD ---
     with tab_fore:
         st.subheader("AI Prediction Model")
         
-        # Merge History and Forecast for visualization
-        fig_pred = go.Figure()
-        
-        # Historical Line
-        hist_slice = df_hist.tail(48) # Last 48h
-        fig_pred.add_trace(go.Scatter(x=hist_slice['Timestamp'], y=hist_slice['L1 Site'], name='Historical', line=dict(color='gray')))
-        
-        # Forecast Line
-        fore_slice = df_forecast.head(48) # Next 48h
-        fig_pred.add_trace(go.Scatter(x=fore_slice['Timestamp'], y=fore_slice['Predicted_Energy'], name='Predicted', line=dict(color='#00CC96', dash='dot')))
-        
-        fig_pred.update_layout(title="Energy Consumption Forecast (Next 48h)", xaxis_title="Time", yaxis_title="kWh")
+        fig_pred = build_forecast_figure(df_hist, df_forecast, last_ts, df_forecast['Timestamp'].iloc[0])
         st.plotly_chart(fig_pred, use_container_width=True)
         
         # Cost Forecast Table
         st.subheader("Predicted Costs per Region (Next 24h)")
-        cols_cost = [c for c in df_forecast.columns if 'cost_safe' in c]
-        st.dataframe(df_forecast[['Timestamp'] + cols_cost].head(24).style.background_gradient(cmap='Reds'))
+        fig_cost = build_cost_table_figure(df_forecast, df_forecast['Timestamp'].iloc[0])
+        st.plotly_chart(fig_cost, use_container_width=True)
 
     # --- TAB 5: INTELLIGENT ADVISOR ---
     with tab_ai:
@@ -261,27 +373,28 @@ def main():
         
         user_query = st.text_input("Ask insights about your energy data:", placeholder="e.g., Which hour is most expensive?")
         
+        def answer_cost():
+            max_cost_row = df_hist.loc[stats['max_cost_idx']]
+            return f"Based on historical data, the most expensive hour was **{max_cost_row.name}** with a cost of **€{max_cost_row[REGION_COLS[region]['amount']]:.2f}** in {region}."
+        
+        def answer_process():
+            return f"The process consuming the most energy is **{stats['proc_sums'].index[0]}**."
+        
+        def answer_optimize():
+            return "Recommendation: **Chillers** are operating at 90% capacity during peak pricing hours (18:00-21:00). Consider pre-cooling during off-peak hours."
+        
+        def answer_default():
+            return "I am analyzing the datasets... Try asking about 'peak hours', 'expensive times', or 'process consumption'."
+        
+        handlers = {'cost': answer_cost, 'proc': answer_process, 'opt': answer_optimize}
+        
         if user_query:
-            response = ""
-            q = user_query.lower()
-            
-            if "expensive" in q or "cost" in q:
-                max_cost_row = df_hist.loc[df_hist[f'{region}_Amount'].idxmax()]
-                response = f"Based on historical data, the most expensive hour was **{max_cost_row['Timestamp']}** with a cost of **€{max_cost_row[f'{region}_Amount']:.2f}** in {region}."
-            
-            elif "process" in q or "consume" in q:
-                # Simple sum comparison
-                proc_sums = df_hist[['Chillers', 'Compressor 1', 'LPDC']].sum().sort_values(ascending=False)
-                response = f"The process consuming the most energy is **{proc_sums.index[0]}**."
-            
-            elif "optimize" in q:
-                response = "Recommendation: **Chillers** are operating at 90% capacity during peak pricing hours (18:00-21:00). Consider pre-cooling during off-peak hours."
-            
-            else:
-                response = "I am analyzing the datasets... Try asking about 'peak hours', 'expensive times', or 'process consumption'."
+            # Single regex pass over the query, then pick the highest-priority intent found
+            found = {m.lastgroup for m in INTENT_RE.finditer(user_query)}
+            intent = next((i for i in INTENT_PRIORITY if i in found), None)
+            response = handlers.get(intent, answer_default)()
             
             st.info(response, icon="🤖")
 
 if __name__ == "__main__":
-    import graphviz # Import here to avoid top-level failure if not installed
     main()